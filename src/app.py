@@ -2,14 +2,15 @@ import os
 import shutil
 from tempfile import TemporaryDirectory
 
-import pandas as pd
 import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
-from bs4 import BeautifulSoup
-from constants import (BACKOFF_FACTOR, BASE_URL, SEC_CIK_TXT_URL,
-                       STATUS_FORCELIST, TICKER_CIK_CSV_FPATH, TOTAL_RETRIES)
+from constants import (BACKOFF_FACTOR, BASE_URL, REQUEST_DEADLINE_SECONDS,
+                       S3_UPLOAD_RESERVE_SECONDS, SEARCH_MAX_HITS,
+                       SEC_CIK_TXT_URL, STATUS_FORCELIST, TOTAL_RETRIES)
+from deadline import (Deadline, DeadlineExceeded, decode_continuation_token,
+                      encode_continuation_token)
 from excel_parsing_utils import (clean_excel,
                                  download_years_in_ticker_folder_from_s3,
                                  filter_s3_urls_to_send,
@@ -18,18 +19,22 @@ from excel_parsing_utils import (clean_excel,
                                  get_fpaths_from_local_ticker,
                                  merge_excel_files_across_years,
                                  parse_inputs, upload_files_to_s3)
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
-from sec_downloader import (SECDownloader, download,
-                            update_ticker_cik_df, http_download)
+from search_index import search_filings
+from sec_downloader import (SECDownloader, SECRequestError, download,
+                            index_restored_years, update_ticker_cik_df,
+                            http_download)
 
 app = FastAPI()
 
 
 app.add_middleware(CORSMiddleware,
                    allow_origins=["*"], allow_credentials=True,
-                   allow_methods=["*"], allow_headers=["*"])
+                   allow_methods=["*"], allow_headers=["*"],
+                   expose_headers=["X-Years-Completed",
+                                   "X-Continuation-Token"])
 
 sec_downloader = SECDownloader()
 
@@ -42,12 +47,17 @@ def home():
 @app.get("/list_sec_filing_10k/")
 async def get_list_sec_tickers(ticker):
 
-    cik = sec_downloader.get_ticker_cik(ticker)
+    from bs4 import BeautifulSoup
+
+    cik = get_ticker_cik(ticker)
 
     params = {"action": "getcompany", "owner": "exclude",
               "output": "html", "CIK": cik, "type": "10-K"}
 
-    data = http_download(BASE_URL, params)
+    try:
+        data = http_download(BASE_URL, params)
+    except (SECRequestError, requests.exceptions.RequestException) as e:
+        raise HTTPException(status_code=502, detail=str(e))
 
     soup = BeautifulSoup(data, features="lxml")
     tables = soup.find_all("td")
@@ -65,73 +75,179 @@ async def get_list_sec_tickers(ticker):
 async def get_list_sec_tickers():
 
     update_ticker_cik_df()
-    df_tickers = pd.read_csv(TICKER_CIK_CSV_FPATH)
+    sec_downloader.init_ticker_cik()
 
-    list_tickers = list(df_tickers["ticker"].dropna().values)
+    list_tickers = sec_downloader.get_tickers()
 
     return {"tickers": list_tickers}
 
 
+@app.get("/search/")
+async def search(q, ticker=None, year=None, form=None,
+                 limit: int = Query(20, ge=1, le=SEARCH_MAX_HITS)):
+
+    # Filings are indexed per CIK, shared by the share classes of a company
+    cik = None
+    if ticker is not None:
+        cik = get_ticker_cik(ticker)
+
+    hits = search_filings(q, cik=cik, year=year, form=form, limit=limit)
+
+    return {"hits": hits}
+
+
 @app.get("/params/")
-async def download_10k(ticker, years, _10k, Proxy, Balance, Income, Cash):
+async def download_10k(ticker, years, _10k, Proxy, Balance, Income, Cash,
+                       continuation_token=None):
+
+    deadline = Deadline(REQUEST_DEADLINE_SECONDS)
 
     with TemporaryDirectory() as dirpath:
-        s3_urls_to_send_to_user, _ = get_s3_urls_to_send_to_user(
-            ticker, years, _10k, Proxy, Balance, Income, Cash, dirpath)
+        (s3_urls_to_send_to_user, _, years_completed,
+         continuation_token) = get_s3_urls_to_send_to_user(
+            ticker, years, _10k, Proxy, Balance, Income, Cash, dirpath,
+            deadline, continuation_token)
 
-        return {"s3_urls": s3_urls_to_send_to_user}
+        return {"s3_urls": s3_urls_to_send_to_user,
+                "years_completed": years_completed,
+                "continuation_token": continuation_token}
 
 
 @app.get("/params_web/")
-async def download_10k_web(ticker, years, _10k, Proxy, Balance, Income, Cash):
+async def download_10k_web(ticker, years, _10k, Proxy, Balance, Income, Cash,
+                           continuation_token=None):
+
+    deadline = Deadline(REQUEST_DEADLINE_SECONDS)
 
     with TemporaryDirectory() as dirpath:
-        _, ticker_folder = get_s3_urls_to_send_to_user(
-            ticker, years, _10k, Proxy, Balance, Income, Cash, dirpath)
+        (_, ticker_folder, years_completed,
+         continuation_token) = get_s3_urls_to_send_to_user(
+            ticker, years, _10k, Proxy, Balance, Income, Cash, dirpath,
+            deadline, continuation_token)
+
+        # The zip only holds the completed years, tell the client which ones
+        # and how to get the rest
+        headers = {"X-Years-Completed": ",".join(years_completed)}
+        if continuation_token is not None:
+            headers["X-Continuation-Token"] = continuation_token
 
         shutil.make_archive(ticker, "zip", ticker_folder)
         response = FileResponse(path=ticker + ".zip",
-                                filename=ticker + ".zip")
+                                filename=ticker + ".zip", headers=headers)
         return response
 
 
+def get_ticker_cik(ticker, deadline=None):
+
+    # An unknown ticker triggers a refresh of the ticker list from the SEC
+    try:
+        cik = sec_downloader.get_ticker_cik(ticker, deadline)
+    except (requests.exceptions.RequestException, DeadlineExceeded) as e:
+        raise HTTPException(status_code=503,
+                            detail=f"Could not refresh the tickers: {e}")
+    if cik is None:
+        raise HTTPException(status_code=404,
+                            detail=f"Unknown ticker {ticker}")
+
+    return cik
+
+
 def get_s3_urls_to_send_to_user(ticker, years, _10k, Proxy,
-                                Balance, Income, Cash, dirpath):
+                                Balance, Income, Cash, dirpath,
+                                deadline, continuation_token=None):
 
     raw_files_to_send, merged_files_to_send, years = parse_inputs(
         _10k, Proxy, Balance, Income, Cash, years)
+    # Years still to fetch from the SEC, all of them unless continuing
+    years_to_fetch = years
+    if continuation_token is not None:
+        try:
+            years, years_to_fetch = decode_continuation_token(
+                continuation_token, ticker)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    # Keep part of the budget to upload what was fetched before the deadline
+    fetch_deadline = deadline.reserve(S3_UPLOAD_RESERVE_SECONDS)
 
-    cik = sec_downloader.get_ticker_cik(ticker)
+    cik = get_ticker_cik(ticker, fetch_deadline)
 
     ticker_folder = os.path.join(dirpath, ticker)
     os.makedirs(ticker_folder)
 
-    existing_s3_urls = download_years_in_ticker_folder_from_s3(
-        ticker,  ticker_folder, years)
-    created_fpath = create_missing_files(ticker, ticker_folder, cik, years)
-    s3_urls = upload_files_to_s3(created_fpath, existing_s3_urls,
-                                 ticker, ticker_folder)
+    existing_s3_urls, s3_pending_years = (
+        download_years_in_ticker_folder_from_s3(
+            ticker,  ticker_folder, years, fetch_deadline))
+    # Years that S3 failed to return are in S3 already, do not rebuild them
+    sec_years = [year for year in years_to_fetch
+                 if year not in s3_pending_years]
+    try:
+        created_fpath, sec_pending_years = create_missing_files(
+            ticker, ticker_folder, cik, sec_years, fetch_deadline)
+    except SECRequestError as e:
+        # Not a transient failure: a continuation would fail the same way
+        raise HTTPException(status_code=502, detail=str(e))
+    # Uploads get the whole budget, including the reserved part
+    s3_urls, failed_fpaths = upload_files_to_s3(
+        created_fpath, existing_s3_urls, ticker, ticker_folder, deadline)
+    upload_pending_years = get_years_of_fpaths(failed_fpaths, ticker_folder,
+                                               years)
+    pending_years = sorted(set(s3_pending_years) | set(sec_pending_years)
+                           | set(upload_pending_years))
 
     s3_urls_to_send_to_user = filter_s3_urls_to_send(
         s3_urls, raw_files_to_send, merged_files_to_send)
+    years_completed = [year for year in years if year not in pending_years]
+
+    # The years left over when the deadline hit can be requested again by
+    # passing the continuation token along with the same parameters
+    if pending_years:
+        continuation_token = encode_continuation_token(ticker, years,
+                                                       pending_years)
+    else:
+        continuation_token = None
 
-    return s3_urls_to_send_to_user, ticker_folder
+    return (s3_urls_to_send_to_user, ticker_folder, years_completed,
+            continuation_token)
 
 
-def create_missing_files(ticker, ticker_folder, cik, years):
+def get_years_of_fpaths(fpaths, ticker_folder, years):
+
+    # Raw files sit in their year folder, merged files at the root of the
+    # ticker folder span all the years
+    fpaths_years = set()
+    for fpath in fpaths:
+        folder = os.path.relpath(fpath, ticker_folder).split(os.sep)[0]
+        if folder in years:
+            fpaths_years.add(folder)
+        else:
+            fpaths_years.update(years)
+
+    return sorted(fpaths_years)
+
+
+def create_missing_files(ticker, ticker_folder, cik, sec_years, deadline):
 
     existing_years = get_existing_years(ticker_folder)
-    missing_years = [year for year in years if year not in existing_years]
+    missing_years = [year for year in sec_years
+                     if year not in existing_years]
 
     if missing_years:
-        excel_fpaths_to_clean, created_years = download(
-            ticker, cik, missing_years, ticker_folder)
+        excel_fpaths_to_clean, created_years, pending_years = download(
+            ticker, cik, missing_years, ticker_folder, deadline)
         for excel_fpath in excel_fpaths_to_clean:
             clean_excel(excel_fpath)
     else:
         created_years = []
+        pending_years = []
+
+    if existing_years:
+        index_restored_years(ticker, cik, existing_years, ticker_folder,
+                             deadline)
 
     local_years = existing_years + created_years
+    if not local_years:
+        return [], pending_years
 
     existing_merged_fpaths = get_existing_merged_fpaths(
         ticker, ticker_folder, local_years)
@@ -143,4 +259,4 @@ def create_missing_files(ticker, ticker_folder, cik, years):
     raw_fpaths = get_fpaths_from_local_ticker(ticker_folder, local_years)
     created_fpath = raw_fpaths + merged_fpaths
 
-    return created_fpath
+    return created_fpath, pending_years
@@ -0,0 +1,70 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+# Measures how long a fresh server process takes to answer the "/" health
+# check, which is what a Cloud Run cold start waits on. Run from src/:
+#   python benchmark_startup.py --runs 5
+
+HEALTH_CHECK_POLL_INTERVAL = 0.01
+
+
+def time_import_app():
+
+    code = ("import time; start = time.perf_counter(); import app; "
+            "print(time.perf_counter() - start)")
+    output = subprocess.run([sys.executable, "-c", code], check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True)
+
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def time_health_check(port, timeout):
+
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1",
+         "--port", str(port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(
+                        f"http://127.0.0.1:{port}/") as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except OSError:
+                time.sleep(HEALTH_CHECK_POLL_INTERVAL)
+        raise TimeoutError(f"No health check answer within {timeout}s")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=30)
+    args = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    import_times = [time_import_app() for _ in range(args.runs)]
+    health_check_times = [time_health_check(args.port, args.timeout)
+                          for _ in range(args.runs)]
+
+    for name, times in (("import app", import_times),
+                        ("first health check", health_check_times)):
+        print(f"{name}: median {statistics.median(times) * 1000:.0f} ms, "
+              f"max {max(times) * 1000:.0f} ms over {args.runs} runs")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
+import os
+
 CIK_URL = ("http://www.sec.gov/cgi-bin/browse-edgar?CIK={}&Find=Search&owner"
            "=exclude&action=getcompany")
 BASE_URL = "http://www.sec.gov/cgi-bin/browse-edgar"
@@ -24,3 +26,33 @@ TICKERS_10K_S3_BUCKET = "tickers-10k"
 TOTAL_RETRIES = 3
 STATUS_FORCELIST = [403]
 BACKOFF_FACTOR = 3
+SEC_HEADERS = {
+	"User-Agent": "My User Agent 1.0",
+}
+SEC_ARCHIVES_URL = "https://www.sec.gov/Archives/edgar/data"
+FILING_STORE_DIR = os.environ.get("FILING_STORE_DIR", "filing_store")
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# On Cloud Run the container filesystem is in memory: keep the store small
+# by default, or point FILING_STORE_DIR at a mounted volume and raise the cap
+FILING_STORE_MAX_BYTES = int(os.environ.get("FILING_STORE_MAX_BYTES",
+                                            256 * 1024 * 1024))
+FILING_STORE_EVICTION_GRACE_SECONDS = 600
+SEC_SUBMISSIONS_URL = "https://data.sec.gov/submissions"
+MAX_SUBMISSIONS_SHARDS_WORKERS = 4
+TICKER_CIK_SNAPSHOT_FPATH = "ticker_cik.pickle"
+REQUEST_DEADLINE_SECONDS = float(os.environ.get("REQUEST_DEADLINE_SECONDS", 60))
+S3_UPLOAD_RESERVE_SECONDS = 10
+SEC_REQUEST_TIMEOUT = 10
+S3_CONNECT_TIMEOUT = 5
+S3_READ_TIMEOUT = 20
+MAX_DOWNLOAD_WORKERS = 4
+MAX_UPLOAD_WORKERS = 4
+# Point it at a mounted volume to keep the index across restarts
+SEARCH_INDEX_FPATH = os.environ.get(
+    "SEARCH_INDEX_FPATH", os.path.join(FILING_STORE_DIR, "search_index.sqlite3"))
+# The index keeps the text of the documents for snippets: bound it so that
+# documents are left room in the filing store, which it counts toward
+SEARCH_INDEX_MAX_BYTES = int(os.environ.get("SEARCH_INDEX_MAX_BYTES",
+                                            FILING_STORE_MAX_BYTES // 2))
+SEARCH_SNIPPET_TOKENS = 16
+SEARCH_MAX_HITS = 100
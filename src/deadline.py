@@ -0,0 +1,115 @@
+import base64
+import json
+import time
+
+import requests
+
+from constants import (BACKOFF_FACTOR, SEC_REQUEST_TIMEOUT, STATUS_FORCELIST,
+                       TOTAL_RETRIES)
+
+# A Deadline is created when a request comes in and handed down to every
+# stage doing network calls, so that a slow SEC or S3 cannot hold a request
+# past its budget: each call gets a timeout bounded by the time left, and
+# the years that could not be completed are returned to the client as a
+# continuation token to resume from. The token keeps the whole range asked
+# for, so that the merged statements still cover it, and the pending years,
+# which are the only ones to fetch from the SEC again.
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline():
+
+    def __init__(self, seconds):
+
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+
+        return max(0, self.expires_at - time.monotonic())
+
+    def expired(self):
+
+        return self.remaining() == 0
+
+    def check(self):
+
+        if self.expired():
+            raise DeadlineExceeded("Request deadline exceeded")
+
+    def timeout(self, max_timeout=SEC_REQUEST_TIMEOUT):
+
+        self.check()
+
+        return min(max_timeout, self.remaining())
+
+    def reserve(self, seconds):
+
+        # Deadline for a stage that must leave `seconds` to the next ones
+        stage_deadline = Deadline(0)
+        stage_deadline.expires_at = self.expires_at - seconds
+
+        return stage_deadline
+
+
+def get_request_timeout(deadline):
+
+    if deadline is None:
+        return SEC_REQUEST_TIMEOUT
+
+    return deadline.timeout()
+
+
+def get_within_deadline(session, url, deadline=None, **kwargs):
+
+    # Same retries and backoff as the urllib3 Retry the session used to be
+    # mounted with, except that a retry is given up on, rather than slept
+    # for, when its backoff does not fit in the time left
+    attempt = 0
+    while True:
+        try:
+            r = session.get(url, timeout=get_request_timeout(deadline),
+                            **kwargs)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout):
+            if attempt == TOTAL_RETRIES:
+                raise
+        else:
+            if (r.status_code not in STATUS_FORCELIST
+                    or attempt == TOTAL_RETRIES):
+                return r
+            r.close()
+
+        backoff = 0 if attempt == 0 else BACKOFF_FACTOR * 2 ** attempt
+        if deadline is not None and backoff >= deadline.remaining():
+            raise DeadlineExceeded(f"No time left to retry {url}")
+        time.sleep(backoff)
+        attempt += 1
+
+
+def encode_continuation_token(ticker, years, pending_years):
+
+    payload = json.dumps({"ticker": ticker.lower(), "years": years,
+                          "pending_years": pending_years})
+
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii")
+
+
+def decode_continuation_token(token, ticker):
+
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        token_ticker = payload["ticker"]
+        years = [str(int(year)) for year in payload["years"]]
+        pending_years = [str(int(year))
+                         for year in payload["pending_years"]]
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Invalid continuation token")
+
+    if token_ticker != ticker.lower():
+        raise ValueError(
+            f"Continuation token was issued for ticker {token_ticker}")
+
+    return years, pending_years
@@ -1,31 +1,58 @@
 import os
 import re
+import shutil
 from collections import defaultdict
-from functools import reduce
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache, reduce
 
-import boto3
-import pandas as pd
 import requests
-from pandas import ExcelWriter, merge, read_excel
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
-from constants import (BACKOFF_FACTOR, REGEX_PER_TARGET_SHEET,
-                       STATUS_FORCELIST, TICKERS_10K_S3_BUCKET, TOTAL_RETRIES)
+from constants import (BACKOFF_FACTOR, MAX_UPLOAD_WORKERS,
+                       REGEX_PER_TARGET_SHEET, S3_CONNECT_TIMEOUT, S3_READ_TIMEOUT, STATUS_FORCELIST,
+                       TICKERS_10K_S3_BUCKET, TOTAL_RETRIES)
 
-aws_access_key_id = os.environ["aws_access_key_id"]
-aws_secret_access_key = os.environ["aws_secret_access_key"]
 
-S3_CLIENT = boto3.client("s3",
-                         aws_access_key_id=aws_access_key_id,
-                         aws_secret_access_key=aws_secret_access_key)
-S3_RESOURCE = boto3.resource("s3",
-                             aws_access_key_id=aws_access_key_id,
-                             aws_secret_access_key=aws_secret_access_key)
+# boto3 and pandas are imported where they are used, and the S3 clients are
+# only built on first use, to keep the server cold start fast
+@lru_cache(maxsize=None)
+def get_s3_client():
+
+    import boto3
+
+    return boto3.client("s3",
+                        aws_access_key_id=os.environ["aws_access_key_id"],
+                        aws_secret_access_key=os.environ[
+                            "aws_secret_access_key"],
+                        config=get_s3_config())
+
+
+@lru_cache(maxsize=None)
+def get_s3_resource():
+
+    import boto3
+
+    return boto3.resource("s3",
+                          aws_access_key_id=os.environ["aws_access_key_id"],
+                          aws_secret_access_key=os.environ[
+                              "aws_secret_access_key"],
+                          config=get_s3_config())
+
+
+def get_s3_config():
+
+    from botocore.config import Config
+
+    return Config(connect_timeout=S3_CONNECT_TIMEOUT,
+                  read_timeout=S3_READ_TIMEOUT,
+                  retries={"max_attempts": TOTAL_RETRIES})
 
 
 def merge_excel_files_across_years(ticker, ticker_folder, years):
 
+    from pandas import ExcelWriter
+
     if not years:
         return []
 
@@ -81,6 +108,8 @@ def merge_excel_files_across_years(ticker, ticker_folder, years):
 
 def get_sheets_per_year_per_target(excel_fpath_per_year):
 
+    import pandas as pd
+
     sheet_per_year_per_target = defaultdict(dict)
     for year, excel_fpath in excel_fpath_per_year.items():
         df_per_target = pd.read_excel(excel_fpath, sheet_name=None)
@@ -141,6 +170,8 @@ def clean_columns_df(sheet_per_year):
 
 def create_merged_df(sheet_per_year, writer, format1):
 
+    from pandas import merge
+
     # Clean columns of all sheets
     sheet_per_year = clean_columns_df(sheet_per_year)
 
@@ -259,6 +290,10 @@ def get_local_excel_fpath_per_year(ticker_folder, years):
         year_folder = os.path.join(ticker_folder, year)
         excel_fnames = [fname for fname in os.listdir(year_folder)
                         if os.path.splitext(fname)[1] == ".xlsx"]
+        if not excel_fnames:
+            # Filings before XBRL have no financial report to merge
+            print(f"No financial report for year {year}, not merged")
+            continue
         assert len(excel_fnames) == 1, (
             f"Not a unique excel_fname for year {year} but {excel_fnames}")
         excel_fpath = os.path.join(year_folder, excel_fnames[0])
@@ -268,6 +303,10 @@ def get_local_excel_fpath_per_year(ticker_folder, years):
 
 
 def clean_excel(excel_fpath):
+
+    import pandas as pd
+    from pandas import read_excel
+
     df_per_sheet = read_excel(excel_fpath, sheet_name=None)
 
     sheet_name_per_title = {}
@@ -298,18 +337,50 @@ def get_first_matching(titles, targets):
     return title
 
 
-def upload_files_to_s3(created_fpaths, existing_s3_urls, ticker, ticker_folder):
+def upload_files_to_s3(created_fpaths, existing_s3_urls, ticker, ticker_folder,
+                       deadline=None):
 
     s3_urls = []
+    uploads = []
+    executor = ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS)
     for fpath in created_fpaths:
         s3_prefix = os.path.join(ticker, fpath.split(ticker_folder + "/")[1])
         s3_url = os.path.join("s3://", TICKERS_10K_S3_BUCKET, s3_prefix)
-        if s3_url not in existing_s3_urls:
-            S3_CLIENT.upload_file(fpath, TICKERS_10K_S3_BUCKET, s3_prefix)
+        if s3_url in existing_s3_urls:
+            s3_urls.append(s3_url)
+        else:
+            future = executor.submit(upload_file_to_s3, fpath, s3_prefix)
+            uploads.append((fpath, s3_url, future))
+
+    # Uploads still queued when the deadline hits are cancelled, running
+    # ones end on the S3 client timeouts
+    futures = [future for _, _, future in uploads]
+    wait(futures, timeout=None if deadline is None else deadline.remaining())
+    for future in futures:
+        future.cancel()
+    executor.shutdown(wait=False)
+
+    failed_fpaths = []
+    for fpath, s3_url, future in uploads:
+        if (future.done() and not future.cancelled()
+                and future.exception() is None):
+            s3_urls.append(s3_url)
+        else:
+            failed_fpaths.append(fpath)
+
+    return s3_urls, failed_fpaths
+
+
+def upload_file_to_s3(fpath, s3_prefix):
 
-        s3_urls.append(s3_url)
+    from boto3.exceptions import S3UploadFailedError
+    from botocore.exceptions import BotoCoreError, ClientError
 
-    return s3_urls
+    try:
+        get_s3_client().upload_file(fpath, TICKERS_10K_S3_BUCKET, s3_prefix)
+    except (S3UploadFailedError, BotoCoreError, ClientError) as e:
+        print(f"Could not upload {fpath} to S3: {e}")
+        raise
 
 
 def parse_inputs(get10k, getProxyStatement, getBalanceSheet,
@@ -331,28 +402,55 @@ def parse_inputs(get10k, getProxyStatement, getBalanceSheet,
     return raw_files_to_send, merged_files_to_send, years
 
 
-def download_years_in_ticker_folder_from_s3(ticker, ticker_folder, years):
+def download_years_in_ticker_folder_from_s3(ticker, ticker_folder, years,
+                                            deadline=None):
 
-    bucket = S3_RESOURCE.Bucket(TICKERS_10K_S3_BUCKET)
-    s3_objects = bucket.objects.filter(Prefix=ticker)
+    from botocore.exceptions import BotoCoreError, ClientError
 
-    existing_s3_urls = []
+    bucket = get_s3_resource().Bucket(TICKERS_10K_S3_BUCKET)
+    try:
+        s3_objects = list(bucket.objects.filter(Prefix=ticker))
+    except (BotoCoreError, ClientError) as e:
+        print(f"Could not list the S3 files of {ticker}: {e}")
+        return [], list(years)
+
+    existing_s3_urls_per_year = defaultdict(list)
+    pending_years = set()
     for s3_obj in s3_objects:
         s3_folder = s3_obj.key.split("/")[1]
         if s3_folder not in years:
             continue
 
+        # Once the deadline hits or S3 fails, the years not fully fetched are
+        # left for a continuation request
+        if s3_folder in pending_years or (
+                deadline is not None and deadline.expired()):
+            pending_years.add(s3_folder)
+            continue
+
         s3_url = os.path.join("s3://", s3_obj.bucket_name, s3_obj.key)
-        existing_s3_urls.append(s3_url)
+        existing_s3_urls_per_year[s3_folder].append(s3_url)
 
         target = os.path.join(ticker_folder, os.path.relpath(s3_obj.key,
                                                              ticker))
         os.makedirs(os.path.dirname(target), exist_ok=True)
         if s3_obj.key[-1] == "/":
             continue
-        bucket.download_file(s3_obj.key, target)
+        try:
+            bucket.download_file(s3_obj.key, target)
+        except (BotoCoreError, ClientError) as e:
+            print(f"Could not download {s3_url}: {e}")
+            pending_years.add(s3_folder)
+
+    existing_s3_urls = []
+    for year, s3_urls in existing_s3_urls_per_year.items():
+        if year in pending_years:
+            shutil.rmtree(os.path.join(ticker_folder, year),
+                          ignore_errors=True)
+        else:
+            existing_s3_urls.extend(s3_urls)
 
-    return existing_s3_urls
+    return existing_s3_urls, sorted(pending_years)
 
 
 def filter_s3_urls_to_send(s3_urls_to_send_to_user, raw_files_to_send,
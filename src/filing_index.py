@@ -0,0 +1,73 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from constants import (FILING_STORE_DIR, MAX_SUBMISSIONS_SHARDS_WORKERS,
+                       SEC_HEADERS, SEC_SUBMISSIONS_URL)
+from deadline import get_within_deadline
+
+# The submissions JSON of a company only lists its most recent filings in
+# "filings.recent"; older ones are paginated in "filings.files" shards, each
+# covering the filing dates [filingFrom, filingTo]. Shards never change once
+# published, so they are cached on disk next to the filings of the CIK.
+
+
+def get_filings_df(session, cik, submissions, years, deadline=None):
+
+    import pandas as pd
+
+    filings = submissions["filings"]
+    shards = [shard for shard in filings.get("files", [])
+              if is_shard_overlapping_years(shard, years)]
+
+    filings_per_page = [filings["recent"]]
+    if shards:
+        with ThreadPoolExecutor(
+                max_workers=MAX_SUBMISSIONS_SHARDS_WORKERS) as executor:
+            shards_filings = executor.map(
+                lambda shard: get_shard_filings(session, cik, shard["name"],
+                                                deadline),
+                shards)
+            filings_per_page.extend(shards_filings)
+
+    df = pd.concat([
+        pd.DataFrame.from_dict(page, orient="index").transpose()
+        for page in filings_per_page], ignore_index=True)
+
+    return df
+
+
+def is_shard_overlapping_years(shard, years):
+
+    # A filing reporting on a given year is filed during that year or the
+    # next one (10-K after the fiscal year end, proxy before the meeting)
+    first_year = min(int(year) for year in years)
+    last_year = max(int(year) for year in years)
+    shard_first_year = int(shard["filingFrom"].split("-")[0])
+    shard_last_year = int(shard["filingTo"].split("-")[0])
+
+    return shard_first_year <= last_year + 1 and shard_last_year >= first_year
+
+
+def get_shard_filings(session, cik, shard_name, deadline=None):
+
+    shard_fpath = os.path.join(FILING_STORE_DIR, str(int(cik)), "submissions",
+                               shard_name)
+    if os.path.exists(shard_fpath):
+        with open(shard_fpath) as f:
+            return json.load(f)
+
+    shard_url = "/".join((SEC_SUBMISSIONS_URL, shard_name))
+    with get_within_deadline(session, shard_url, deadline,
+                             headers=SEC_HEADERS) as r:
+        # A missing shard must not pass for years without filings
+        r.raise_for_status()
+        shard_filings = r.json()
+
+    os.makedirs(os.path.dirname(shard_fpath), exist_ok=True)
+    tmp_fpath = shard_fpath + ".tmp"
+    with open(tmp_fpath, "w") as f:
+        json.dump(shard_filings, f)
+    os.replace(tmp_fpath, shard_fpath)
+
+    return shard_filings
@@ -0,0 +1,296 @@
+import fcntl
+import glob
+import hashlib
+import os
+import re
+import shutil
+import time
+from contextlib import contextmanager
+
+from constants import (DOWNLOAD_CHUNK_SIZE, FILING_STORE_DIR,
+                       FILING_STORE_EVICTION_GRACE_SECONDS,
+                       FILING_STORE_MAX_BYTES, SEARCH_INDEX_FPATH,
+                       SEC_ARCHIVES_URL, SEC_HEADERS, STATUS_FORCELIST)
+from deadline import get_within_deadline
+
+# Filings are stored once per CIK and accession number, whatever the ticker
+# they were requested for:
+#   {FILING_STORE_DIR}/{cik}/{accession}/{document}
+#   {FILING_STORE_DIR}/{cik}/{accession}/{document}.sha256
+# A download in progress lives in "{document}.part" and is resumed with a
+# Range request if it gets interrupted, e.g. when the request deadline hits
+# in the middle of a large document.
+# The store is capped to FILING_STORE_MAX_BYTES: least recently used
+# documents are evicted once a download is done, and fetched again from the
+# SEC the next time they are requested. The search index counts toward the
+# cap when it is kept in the store folder.
+PART_EXT = ".part"
+SHA256_EXT = ".sha256"
+LOCK_EXT = ".lock"
+CONTENT_RANGE_REGEX = re.compile(r"bytes (\d+)-\d+/(\d+|\*)")
+
+
+class IncompleteDownload(Exception):
+    pass
+
+
+def get_filing_fpath(cik, accession_number, document):
+
+    accession_folder = accession_number.replace("-", "")
+    fpath = os.path.join(FILING_STORE_DIR, str(int(cik)), accession_folder,
+                         document)
+
+    return fpath
+
+
+def get_filing_url(cik, accession_number, document):
+
+    url = os.path.join(SEC_ARCHIVES_URL, str(int(cik)),
+                       accession_number.replace("-", ""), document)
+
+    return url
+
+
+def fetch_filing(session, url, cik, accession_number, document,
+                 deadline=None):
+
+    fpath = get_filing_fpath(cik, accession_number, document)
+
+    with filing_lock(fpath):
+        if is_stored(fpath):
+            return fpath
+        if stream_to_store(session, url, fpath, deadline):
+            return fpath
+
+    return None
+
+
+@contextmanager
+def filing_lock(fpath):
+
+    # Serialize concurrent fetches of the same filing across threads and
+    # worker processes so that it is only requested from the SEC once.
+    # Eviction deletes the lock file (and empty folders) while holding it, so
+    # a lock taken on a file that is no longer at its path is taken again
+    lock_fpath = fpath + LOCK_EXT
+    while True:
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        try:
+            lock_file = open(lock_fpath, "a")
+        except FileNotFoundError:
+            continue
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            is_current = (os.fstat(lock_file.fileno()).st_ino
+                          == os.stat(lock_fpath).st_ino)
+        except FileNotFoundError:
+            is_current = False
+        if is_current:
+            break
+        lock_file.close()
+
+    try:
+        yield
+    finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+
+def is_stored(fpath):
+
+    sha256_fpath = fpath + SHA256_EXT
+    if not (os.path.exists(fpath) and os.path.exists(sha256_fpath)):
+        return False
+
+    with open(sha256_fpath) as f:
+        expected_sha256 = f.read().strip()
+    if hash_file(fpath).hexdigest() == expected_sha256:
+        # Mark the document as recently used for eviction
+        os.utime(fpath)
+        return True
+
+    print(f"Corrupted filing in store, fetching it again: {fpath}")
+    os.remove(fpath)
+    os.remove(sha256_fpath)
+    return False
+
+
+def add_to_store(src_fpath, cik, accession_number, document):
+
+    # Store a copy of the filing obtained elsewhere, e.g. restored from S3
+    fpath = get_filing_fpath(cik, accession_number, document)
+
+    with filing_lock(fpath):
+        if not is_stored(fpath):
+            part_fpath = fpath + PART_EXT
+            shutil.copyfile(src_fpath, part_fpath)
+            with open(fpath + SHA256_EXT, "w") as f:
+                f.write(hash_file(part_fpath).hexdigest())
+            os.replace(part_fpath, fpath)
+
+    return fpath
+
+
+def stream_to_store(session, url, fpath, deadline=None):
+
+    part_fpath = fpath + PART_EXT
+    # Ask for the raw bytes: Range offsets apply to the encoded body, so the
+    # size of a part decoded from a gzip response is no offset to resume from
+    headers = dict(SEC_HEADERS)
+    headers["Accept-Encoding"] = "identity"
+
+    resume_from = 0
+    if os.path.exists(part_fpath):
+        resume_from = os.path.getsize(part_fpath)
+        headers["Range"] = f"bytes={resume_from}-"
+
+    with get_within_deadline(session, url, deadline, headers=headers,
+                             stream=True) as r:
+        status_code = r.status_code
+        if status_code == 206 and get_range_start(r) == resume_from:
+            sha256 = hash_file(part_fpath)
+            mode = "ab"
+        elif status_code == 200:
+            sha256 = hashlib.sha256()
+            mode = "wb"
+        elif resume_from and status_code in (206, 416):
+            # The part file does not line up with the document on the server
+            mode = None
+        elif status_code >= 500 or status_code in STATUS_FORCELIST:
+            # Leaves the year pending for a continuation request
+            r.raise_for_status()
+        else:
+            print(f"Wrong status code: {status_code} when requesting {url}")
+            return False
+
+        if mode is not None:
+            expected_size = get_expected_size(r, resume_from)
+            with open(part_fpath, mode) as output:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    output.write(chunk)
+                    sha256.update(chunk)
+                    if deadline is not None:
+                        deadline.check()
+
+    if mode is None:
+        print(f"Cannot resume {part_fpath}, downloading it again")
+        os.remove(part_fpath)
+        return stream_to_store(session, url, fpath, deadline)
+
+    size = os.path.getsize(part_fpath)
+    if expected_size is not None and size != expected_size:
+        if size > expected_size:
+            os.remove(part_fpath)
+        raise IncompleteDownload(
+            f"Got {size} bytes out of {expected_size} for {url}")
+
+    with open(fpath + SHA256_EXT, "w") as f:
+        f.write(sha256.hexdigest())
+    os.replace(part_fpath, fpath)
+
+    return True
+
+
+def get_range_start(r):
+
+    match = CONTENT_RANGE_REGEX.match(r.headers.get("Content-Range", ""))
+    if match is None:
+        return None
+
+    return int(match.group(1))
+
+
+def get_expected_size(r, resume_from):
+
+    # Size of the whole document once the response is appended to the part
+    if r.status_code == 206:
+        match = CONTENT_RANGE_REGEX.match(r.headers.get("Content-Range", ""))
+        if match is not None and match.group(2) != "*":
+            return int(match.group(2))
+    else:
+        resume_from = 0
+
+    content_length = r.headers.get("Content-Length")
+    if content_length is None:
+        return None
+
+    return resume_from + int(content_length)
+
+
+def evict_filings(max_bytes=FILING_STORE_MAX_BYTES):
+
+    # Documents and part files, whose mtime is bumped on every use
+    fpaths = [fpath for fpath in glob.glob(
+                  os.path.join(FILING_STORE_DIR, "*", "*", "*"))
+              if os.path.basename(os.path.dirname(fpath)) != "submissions"
+              and not fpath.endswith((SHA256_EXT, LOCK_EXT))]
+
+    stats = []
+    for fpath in fpaths:
+        try:
+            stats.append((os.path.getmtime(fpath), os.path.getsize(fpath),
+                          fpath))
+        except FileNotFoundError:
+            continue
+
+    store_size = sum(size for _, size, _ in stats) + get_search_index_size()
+    # Documents used by requests still in flight are never evicted
+    evictable_before = time.time() - FILING_STORE_EVICTION_GRACE_SECONDS
+    for mtime, size, fpath in sorted(stats):
+        if store_size <= max_bytes or mtime > evictable_before:
+            break
+        document_fpath = fpath[:-len(PART_EXT)] if fpath.endswith(
+            PART_EXT) else fpath
+        with filing_lock(document_fpath):
+            for evicted_fpath in (fpath, fpath + SHA256_EXT):
+                if os.path.exists(evicted_fpath):
+                    os.remove(evicted_fpath)
+            if not any(os.path.exists(document_fpath + ext)
+                       for ext in ("", PART_EXT, SHA256_EXT)):
+                os.remove(document_fpath + LOCK_EXT)
+        remove_empty_folders(os.path.dirname(document_fpath))
+        store_size -= size
+
+    return store_size
+
+
+def get_search_index_size():
+
+    # An index kept on another volume does not take room in the store
+    index_folder = os.path.dirname(os.path.abspath(SEARCH_INDEX_FPATH))
+    if index_folder != os.path.abspath(FILING_STORE_DIR):
+        return 0
+
+    try:
+        return os.path.getsize(SEARCH_INDEX_FPATH)
+    except FileNotFoundError:
+        return 0
+
+
+def remove_empty_folders(accession_folder):
+
+    # The accession folder, then the CIK folder once it holds nothing else
+    for folder in (accession_folder, os.path.dirname(accession_folder)):
+        try:
+            os.rmdir(folder)
+        except OSError:
+            return
+
+
+def hash_file(fpath):
+
+    sha256 = hashlib.sha256()
+    with open(fpath, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+
+    return sha256
+
+
+def copy_from_store(store_fpath, dst_fpath):
+
+    # Copy rather than hard link: downstream steps such as clean_excel rewrite
+    # files in place, which must not alter the stored filing
+    shutil.copyfile(store_fpath, dst_fpath)
+
+    return dst_fpath
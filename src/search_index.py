@@ -0,0 +1,183 @@
+import os
+import re
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+import requests
+
+from constants import (SEARCH_INDEX_FPATH, SEARCH_INDEX_MAX_BYTES,
+                       SEARCH_MAX_HITS, SEARCH_SNIPPET_TOKENS)
+from filing_store import IncompleteDownload, fetch_filing, get_filing_url
+
+# Full-text index of the 10-K and proxy statement HTML documents of the
+# filing store, kept in a SQLite FTS5 table next to it. Like the store, it
+# has one row per CIK, accession number and document, so that share classes
+# of a company share their rows: searching by ticker goes through its CIK.
+# Documents are indexed by a background thread once downloaded, off the
+# request path, and FTS5 merges its index segments incrementally as new
+# filings come in. Ranking uses the bm25 score of FTS5.
+# Documents evicted from the store before their turn comes are fetched again
+# from the SEC. Years restored from S3 rather than downloaded, e.g. after a
+# restart lost the index, are indexed the next time they are requested.
+# The FTS5 table keeps its own copy of the text, which snippets are built
+# from, so the index stops growing at SEARCH_INDEX_MAX_BYTES.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS filings (
+    id INTEGER PRIMARY KEY,
+    cik TEXT NOT NULL,
+    accession_number TEXT NOT NULL,
+    document TEXT NOT NULL,
+    year TEXT NOT NULL,
+    form TEXT NOT NULL,
+    UNIQUE (cik, accession_number, document)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS filing_texts USING fts5(
+    body, tokenize = "porter unicode61"
+);
+"""
+BODY_COLUMN = 0
+
+# A single worker keeps the writes of a process to the index sequential
+INDEX_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
+
+def get_connection():
+
+    os.makedirs(os.path.dirname(SEARCH_INDEX_FPATH) or ".", exist_ok=True)
+    connection = sqlite3.connect(SEARCH_INDEX_FPATH, timeout=30)
+    connection.executescript(SCHEMA)
+
+    return connection
+
+
+def index_filings_in_background(session, cik, documents):
+
+    # documents: (accession_number, document, year, form)
+    if documents:
+        INDEX_EXECUTOR.submit(index_filings, session, cik, documents)
+
+
+def index_filings(session, cik, documents):
+
+    cik = str(int(cik))
+    try:
+        with closing(get_connection()) as connection:
+            for accession_number, document, year, form in documents:
+                if is_indexed(connection, cik, accession_number, document):
+                    continue
+                if os.path.getsize(SEARCH_INDEX_FPATH) >= SEARCH_INDEX_MAX_BYTES:
+                    print(f"Search index is full, not indexing CIK {cik}")
+                    break
+                # From the store, or the SEC again if evicted meanwhile
+                url = get_filing_url(cik, accession_number, document)
+                try:
+                    fpath = fetch_filing(session, url, cik, accession_number,
+                                         document)
+                except (requests.exceptions.RequestException,
+                        IncompleteDownload) as e:
+                    print(f"Could not fetch {url} to index it: {e}")
+                    continue
+                if fpath is None:
+                    continue
+                text = extract_text(fpath)
+                # One short transaction per document so that other workers
+                # are not locked out of the index while a filing is parsed
+                with connection:
+                    insert_filing(connection, cik, accession_number,
+                                  document, year, form, text)
+    except sqlite3.Error as e:
+        print(f"Could not update the search index for CIK {cik}: {e}")
+
+
+def is_indexed(connection, cik, accession_number, document):
+
+    row = connection.execute(
+        "SELECT 1 FROM filings WHERE cik = ? AND accession_number = ? "
+        "AND document = ?", (cik, accession_number, document)).fetchone()
+
+    return row is not None
+
+
+def get_unindexed_years(cik, years):
+
+    cik = str(int(cik))
+    try:
+        with closing(get_connection()) as connection:
+            indexed_years = {year for (year,) in connection.execute(
+                "SELECT DISTINCT year FROM filings WHERE cik = ?", (cik,))}
+    except sqlite3.Error as e:
+        print(f"Could not read the search index for CIK {cik}: {e}")
+        return []
+
+    return [year for year in years if year not in indexed_years]
+
+
+def extract_text(fpath):
+
+    from bs4 import BeautifulSoup
+
+    with open(fpath, "rb") as f:
+        soup = BeautifulSoup(f, features="lxml")
+
+    # Inline XBRL filings carry their hidden machine-readable facts in
+    # ix:header, which is not part of the document text
+    for tag in soup.find_all(["script", "style", "ix:header"]):
+        tag.decompose()
+    text = soup.get_text(" ")
+
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def insert_filing(connection, cik, accession_number, document, year, form,
+                  text):
+
+    # Another worker process may have indexed the same filing meanwhile
+    cursor = connection.execute(
+        "INSERT OR IGNORE INTO filings "
+        "(cik, accession_number, document, year, form) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (cik, accession_number, document, year, form))
+    if cursor.rowcount == 1:
+        connection.execute(
+            "INSERT INTO filing_texts (rowid, body) VALUES (?, ?)",
+            (cursor.lastrowid, text))
+
+
+def search_filings(query, cik=None, year=None, form=None, limit=20):
+
+    # Quote every term so that user input is never parsed as FTS5 syntax;
+    # the terms are then all required to match
+    terms = re.findall(r"\w+", query)
+    if not terms:
+        return []
+    match = " ".join(f'"{term}"' for term in terms)
+
+    sql = ("SELECT filings.cik, filings.accession_number, filings.document, "
+           "filings.year, filings.form, bm25(filing_texts), "
+           f"snippet(filing_texts, {BODY_COLUMN}, '<b>', '</b>', '...', "
+           f"{SEARCH_SNIPPET_TOKENS}) "
+           "FROM filing_texts JOIN filings ON filings.id = filing_texts.rowid "
+           "WHERE filing_texts MATCH ?")
+    params = [match]
+    for column, value in (("cik", cik and str(int(cik))), ("year", year),
+                          ("form", form)):
+        if value is not None:
+            sql += f" AND filings.{column} = ?"
+            params.append(value)
+    sql += " ORDER BY bm25(filing_texts) LIMIT ?"
+    # SQLite reads a negative LIMIT as no limit at all
+    params.append(max(1, min(int(limit), SEARCH_MAX_HITS)))
+
+    with closing(get_connection()) as connection:
+        rows = connection.execute(sql, params).fetchall()
+
+    # bm25 is lower for better matches, flip it so that higher is better
+    hits = [{"cik": hit_cik, "accession_number": accession_number,
+             "document": document, "year": hit_year, "form": hit_form,
+             "score": -score, "snippet": snippet}
+            for (hit_cik, accession_number, document, hit_year, hit_form,
+                 score, snippet) in rows]
+
+    return hits
@@ -1,24 +1,27 @@
 import os
-import sys
-import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
 
-import pandas as pd
 import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
-
-from bs4 import BeautifulSoup
-from constants import (_10K_FILING_TYPE, BACKOFF_FACTOR, BASE_URL, HTM_EXT,
-                       MAP_SEC_PREFIX, PROXY_STATEMENT_FILING_TYPE,
-                       SEC_CIK_TXT_URL, STATUS_FORCELIST, TICKER_CIK_CSV_FPATH,
-                       TOTAL_RETRIES, XLSX_EXT)
 
+from constants import (_10K_FILING_TYPE, BASE_URL, HTM_EXT, MAP_SEC_PREFIX,
+                       MAX_DOWNLOAD_WORKERS, PROXY_STATEMENT_FILING_TYPE,
+                       SEC_CIK_TXT_URL, SEC_HEADERS, SEC_SUBMISSIONS_URL,
+                       STATUS_FORCELIST, TICKER_CIK_CSV_FPATH, XLSX_EXT)
+from deadline import DeadlineExceeded, get_within_deadline
+from filing_index import get_filings_df
+from filing_store import (add_to_store, copy_from_store, evict_filings,
+                          fetch_filing, get_filing_url)
+from search_index import get_unindexed_years, index_filings_in_background
+from ticker_index import compile_snapshot, load_cik_per_ticker
+
+# Retries are done by get_within_deadline, which keeps them within the
+# request deadline
 session = requests.Session()
-retry = Retry(total=TOTAL_RETRIES, status_forcelist=STATUS_FORCELIST,
-              backoff_factor=BACKOFF_FACTOR)
-adapter = HTTPAdapter(max_retries=retry)
-session.mount("http://", adapter)
-session.mount("https://", adapter)
+
+
+class SECRequestError(Exception):
+    pass
 
 
 class SECDownloader():
@@ -28,20 +31,27 @@ class SECDownloader():
         # self.ticker = None
         # self.years = None
 
-        self.ticker_cik_df = None
+        # Loaded on first lookup to keep the server cold start fast
         self.cik_per_ticker = None
-        self.init_ticker_cik()
 
     def init_ticker_cik(self):
-        self.ticker_cik_df = pd.read_csv(TICKER_CIK_CSV_FPATH)
-        self.cik_per_ticker = dict(zip(self.ticker_cik_df.ticker,
-                                       self.ticker_cik_df.cik))
+        self.cik_per_ticker = load_cik_per_ticker()
 
-    def get_ticker_cik(self, ticker):
+    def get_tickers(self):
+
+        if self.cik_per_ticker is None:
+            self.init_ticker_cik()
+
+        return list(self.cik_per_ticker)
+
+    def get_ticker_cik(self, ticker, deadline=None):
+
+        if self.cik_per_ticker is None:
+            self.init_ticker_cik()
 
         ticker_lower = ticker.lower()
         if ticker_lower not in self.cik_per_ticker:
-            update_ticker_cik_df()
+            update_ticker_cik_df(deadline)
             self.init_ticker_cik()
             if ticker_lower not in self.cik_per_ticker:
                 return None
@@ -49,43 +59,57 @@ class SECDownloader():
         return str(self.cik_per_ticker[ticker_lower])
 
 
-def update_ticker_cik_df():
+def update_ticker_cik_df(deadline=None):
 
-    with session.get(SEC_CIK_TXT_URL) as r:
+    import pandas as pd
+
+    with get_within_deadline(session, SEC_CIK_TXT_URL, deadline) as r:
+        r.raise_for_status()
         content = r.content.decode("utf-8")
 
     rows = [line.split("\t") for line in content.splitlines()]
     df = pd.DataFrame(rows, columns=["ticker", "cik"])
     df.to_csv(TICKER_CIK_CSV_FPATH)
+    compile_snapshot()
 
     return df
 
 
 def build_url(row, cik):
 
-    url = os.path.join("https://www.sec.gov/Archives/edgar/data", 
-        str(cik), 
-        row.accessionNumber.replace("-", ""),
-        row.primaryDocument
-    )
+    url = get_filing_url(cik, row.accessionNumber, row.primaryDocument)
 
     return url
 
 
-def get_files_urls_and_year(ticker, cik, years):
+def get_local_fpath(ticker_folder, ticker, row):
+
+    prefix = MAP_SEC_PREFIX[row.form]
+    ext = os.path.splitext(row.url)[1]
+    fpath = os.path.join(ticker_folder, row.year,
+                         f"{ticker.upper()}_{prefix}_{row.year}{ext}")
+
+    return fpath
+
+
+def get_files_urls_and_year(ticker, cik, years, deadline=None):
+
+    import pandas as pd
 
     cik_leading_zeros = "0" * (10 - len(str(cik))) + str(cik)
-    URL_JSON = f"https://data.sec.gov/submissions/CIK{cik_leading_zeros}.json"
-    json_content = download_file_from_url(URL_JSON)
+    URL_JSON = f"{SEC_SUBMISSIONS_URL}/CIK{cik_leading_zeros}.json"
+    json_content = download_file_from_url(URL_JSON, deadline=deadline)
 
-    filings = json_content["filings"]["recent"]
-    df = pd.DataFrame.from_dict(filings, orient='index').transpose()
+    df = get_filings_df(session, cik, json_content, years, deadline)
     df["year"] = df["reportDate"].apply(lambda date: date.split("-")[0])
 
     forms_to_keep = MAP_SEC_PREFIX.keys()
     mask_forms_years = df.form.isin(forms_to_keep) & df.year.isin(years)
     df = df.loc[mask_forms_years]
     df_10k = df.loc[df.form.isin(("10-K", "10-K/A"))].copy()
+    # Financial_Report.xlsx only exists for XBRL filings (from about 2009)
+    if "isXBRL" in df_10k:
+        df_10k = df_10k.loc[df_10k.isXBRL == 1]
     df_10k.primaryDocument = "Financial_Report.xlsx"
     df = pd.concat((df, df_10k))
 
@@ -94,51 +118,136 @@ def get_files_urls_and_year(ticker, cik, years):
     return df
 
 
-def download(ticker, cik, years, ticker_folder):
+def download(ticker, cik, years, ticker_folder, deadline=None):
 
-    df = get_files_urls_and_year(ticker, cik, years)
-    fiscal_years_10k = list(df.year.unique())
+    try:
+        df = get_files_urls_and_year(ticker, cik, years, deadline)
+    # ValueError: with requests 2.25, r.json() on a garbled body raises a
+    # plain ValueError rather than a RequestException
+    except (requests.exceptions.RequestException, DeadlineExceeded,
+            ValueError) as e:
+        if not is_transient_error(e):
+            raise SECRequestError(
+                f"Could not list the filings of {ticker}: {e}")
+        print(f"Could not list the filings of {ticker}: {e}")
+        return [], [], list(years)
+
+    # Filings are fetched in parallel into the filing store. When the
+    # deadline hits, queued fetches are cancelled and running ones are left
+    # to end on their own timeout: they only write to the store, where the
+    # next request resumes them
+    rows = [row for _, row in df.iterrows()]
+    executor = ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS)
+    futures = [executor.submit(fetch_filing, session, row.url, cik,
+                               row.accessionNumber, row.primaryDocument,
+                               deadline)
+               for row in rows]
+    wait(futures, timeout=None if deadline is None else deadline.remaining())
+    for future in futures:
+        future.cancel()
+    executor.shutdown(wait=False)
+
+    pending_years = set()
+    for row, future in zip(rows, futures):
+        if (not future.done() or future.cancelled()
+                or future.exception() is not None):
+            pending_years.add(row.year)
+
+    fiscal_years_10k = [year for year in df.year.unique()
+                        if year not in pending_years]
 
     excel_fpaths = []
-    for _, row in df.iterrows():
+    documents_to_index = []
+    for row, future in zip(rows, futures):
+
+        if row.year in pending_years:
+            continue
 
-        year_folder = os.path.join(ticker_folder, row.year)
-        os.makedirs(year_folder, exist_ok=True)
+        fpath = get_local_fpath(ticker_folder, ticker, row)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        ext = os.path.splitext(fpath)[1]
 
-        prefix = MAP_SEC_PREFIX[row.form]
-        ext = os.path.splitext(row.url)[1]
-        fpath = os.path.join(
-            year_folder, f"{ticker.upper()}_{prefix}_{row.year}{ext}")
+        store_fpath = future.result()
+        if store_fpath is None:
+            continue
+        copy_from_store(store_fpath, fpath)
 
         if row.primaryDocument == "Financial_Report.xlsx":
-            excel_fpath = download_file_from_url(row.url, fpath)
-            excel_fpaths.append(excel_fpath)
-        else:
-            download_file_from_url(row.url, fpath)
+            excel_fpaths.append(fpath)
+        elif ext.startswith(HTM_EXT):
+            documents_to_index.append((row.accessionNumber,
+                                       row.primaryDocument, row.year,
+                                       row.form))
 
-    return excel_fpaths, fiscal_years_10k
+    index_filings_in_background(session, cik, documents_to_index)
+    evict_filings()
 
+    return excel_fpaths, fiscal_years_10k, sorted(pending_years)
 
-def http_download(url, params=None, retries=3):
+
+def index_restored_years(ticker, cik, years, ticker_folder, deadline=None):
+
+    # Years restored from S3 skip the download, so they were never indexed
+    # if they were built before the index existed or on an instance whose
+    # index was lost on restart. Their local HTML documents are added to the
+    # filing store and indexed from there
+    unindexed_years = get_unindexed_years(cik, years)
+    if not unindexed_years:
+        return
 
     try:
-        with session.get(url, params=params) as r:
-            if r.status_code != 200:
-                print(r.status_code)
-                sys.exit(f"Wrong status code {r.status_code} when querying {url}")
-            data = r.text
-    except requests.exceptions.RetryError:
-        if retries:
-            time.sleep(2)
-            http_download(url, params=params, retries=retries-1)
-        else:
-            sys.exit(f"Exceeded max retries when querying {url}")
+        df = get_files_urls_and_year(ticker, cik, unindexed_years, deadline)
+    except (requests.exceptions.RequestException, DeadlineExceeded,
+            ValueError) as e:
+        print(f"Could not list the filings of {ticker} to index them: {e}")
+        return
+
+    rows = [row for _, row in df.iterrows()
+            if os.path.splitext(row.url)[1].startswith(HTM_EXT)]
+    fpaths = [get_local_fpath(ticker_folder, ticker, row) for row in rows]
+    # Filings of the same form and year share their local file name, which
+    # then cannot tell them apart: those are fetched from the SEC instead
+    fpath_counts = Counter(fpaths)
+
+    documents_to_index = []
+    for row, fpath in zip(rows, fpaths):
+        if fpath_counts[fpath] == 1 and os.path.exists(fpath):
+            add_to_store(fpath, cik, row.accessionNumber, row.primaryDocument)
+        documents_to_index.append((row.accessionNumber, row.primaryDocument,
+                                   row.year, row.form))
+
+    index_filings_in_background(session, cik, documents_to_index)
+    evict_filings()
+
+
+def is_transient_error(e):
+
+    # Errors worth a continuation request: timeouts, throttling that outlived
+    # the retries, server errors or a truncated body. Other HTTP errors (such
+    # as a 404) would fail the same way on every continuation
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        status_code = e.response.status_code
+        return status_code >= 500 or status_code in STATUS_FORCELIST
+
+    return True
+
+
+def http_download(url, params=None, deadline=None):
+
+    with get_within_deadline(session, url, deadline, params=params) as r:
+        if r.status_code != 200:
+            raise SECRequestError(
+                f"Wrong status code {r.status_code} when querying {url}")
+        data = r.text
 
     return data
 
 
 def get_folders_urls(filing_type, years, cik):
 
+    import pandas as pd
+    from bs4 import BeautifulSoup
+
     last_year_param = str(int(years[-1]) + 1) + "1231"
 
     params = {"action": "getcompany", "owner": "exclude",
@@ -161,6 +270,8 @@ def get_folders_urls(filing_type, years, cik):
 
 def get_fiscal_year(index_url):
 
+    from bs4 import BeautifulSoup
+
     data = http_download(index_url)
 
     soup = BeautifulSoup(data, features="lxml")
@@ -177,6 +288,9 @@ def get_fiscal_year(index_url):
 
 def get_file_url(index_url, filing_type):
 
+    import pandas as pd
+    from bs4 import BeautifulSoup
+
     data = http_download(index_url)
 
     soup = BeautifulSoup(data, features="lxml")
@@ -196,21 +310,10 @@ def get_file_url(index_url, filing_type):
     return file_url
 
 
-def download_file_from_url(file_url, fpath=None):
-
-    HEADERS = {
-        "User-Agent": "My User Agent 1.0",
-    }
-
-    with session.get(file_url, headers=HEADERS) as r:
-        status_code = r.status_code
-        if status_code == 200:
-            if fpath is None:
-                return r.json()
-            else:
-                with open(fpath, "wb") as output:
-                    output.write(r.content)
-                return fpath
-        else:
-            print(f"Wrong status code: {status_code} when requesting {file_url}")
-            return None
+def download_file_from_url(file_url, deadline=None):
+
+    # Only used for JSON documents: filings go through the filing store
+    with get_within_deadline(session, file_url, deadline,
+                             headers=SEC_HEADERS) as r:
+        r.raise_for_status()
+        return r.json()
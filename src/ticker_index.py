@@ -0,0 +1,50 @@
+import csv
+import os
+import pickle
+
+from constants import TICKER_CIK_CSV_FPATH, TICKER_CIK_SNAPSHOT_FPATH
+
+# Parsing the ticker CSV with pandas on every cold start is slow, so the
+# ticker -> CIK mapping is also kept as a pickled dict which loads in a few
+# milliseconds. The snapshot is compiled in the Docker image and rebuilt
+# whenever the CSV is newer than it.
+
+
+def load_cik_per_ticker():
+
+    if is_snapshot_up_to_date():
+        with open(TICKER_CIK_SNAPSHOT_FPATH, "rb") as f:
+            return pickle.load(f)
+
+    return compile_snapshot()
+
+
+def is_snapshot_up_to_date():
+
+    if not os.path.exists(TICKER_CIK_SNAPSHOT_FPATH):
+        return False
+
+    return (os.path.getmtime(TICKER_CIK_SNAPSHOT_FPATH)
+            >= os.path.getmtime(TICKER_CIK_CSV_FPATH))
+
+
+def compile_snapshot():
+
+    cik_per_ticker = {}
+    with open(TICKER_CIK_CSV_FPATH, newline="") as f:
+        for row in csv.DictReader(f):
+            if row["ticker"] and row["cik"]:
+                cik_per_ticker[row["ticker"]] = row["cik"]
+
+    tmp_fpath = TICKER_CIK_SNAPSHOT_FPATH + ".tmp"
+    with open(tmp_fpath, "wb") as f:
+        pickle.dump(cik_per_ticker, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_fpath, TICKER_CIK_SNAPSHOT_FPATH)
+
+    return cik_per_ticker
+
+
+if __name__ == "__main__":
+    cik_per_ticker = compile_snapshot()
+    print(f"Compiled {len(cik_per_ticker)} tickers into "
+          f"{TICKER_CIK_SNAPSHOT_FPATH}")